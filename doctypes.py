@@ -3,6 +3,8 @@ from __future__ import annotations
 from collections import Counter
 from dataclasses import dataclass
 
+import numpy as np
+
 
 @dataclass
 class Document:
@@ -27,3 +29,21 @@ class LanguageModel:
     counter: Counter[str, int]
     total: int
     smoothing_constant: int
+
+
+@dataclass
+class InvertedIndex:
+    """Dataclass for an inverted index with BM25 and language model statistics."""
+    # Per-term arrays end with an entry for words outside the collection
+    terms: dict[str, int]  # Mapping of words to term indices
+    doc_ids: np.ndarray  # Document id of each document index
+    doc_len_norm: np.ndarray  # |D| / avgdl of each document index
+    doc_totals: np.ndarray  # Language model total of each document index
+    doc_unseen_probs: np.ndarray  # Probability of an unseen word in each document
+    offsets: np.ndarray  # Postings of term t are at [offsets[t], offsets[t + 1])
+    postings_ids: np.ndarray  # Document index of each posting
+    postings_tfs: np.ndarray  # Term frequency of each posting
+    idf: np.ndarray  # idf of each term index
+    max_tfs: np.ndarray  # Highest term frequency of each term index
+    min_len_norm: np.ndarray  # Lowest |D| / avgdl in the postings of each term
+    collection_probs: np.ndarray  # Collection probability of each term index
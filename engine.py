@@ -1,7 +1,8 @@
-import pickle
+import numpy as np
 
-from ranker import calculate_bm25
-from util import clean_words, convert_itos, replace_unknown_words
+from process_docs import init_index
+from ranker import calculate_bm25_scores
+from util import clean_query, rank_scores
 
 
 class BM25Engine():
@@ -10,45 +11,31 @@ class BM25Engine():
         self._load_data()
 
     def _load_data(self):
-        # Load the processed data
-        with open(self.data_path, 'rb') as fp:
-            data = pickle.load(fp)
-        self.vocab = data['vocab']
-        self.docs_map = {}
-        for doc in data['docs']:
-            convert_itos(doc.title, self.vocab)
-            convert_itos(doc.content, self.vocab)
-            self.docs_map[doc.id] = doc
-        self.inverted_index = data['inverted_index']
-
-    def _process_query(self, query: str):
-        # Clean and tokenize the query and replace unknown words
-        query = replace_unknown_words(clean_words(query), self.vocab)
-
-        # Get the ids of all documents with a word in the query
-        doc_ids = set(doc_id for word in query
-                      for doc_id in self.inverted_index[word])
-
-        # Get the respective documents
-        hits = [self.docs_map[doc_id] for doc_id in doc_ids]
-
-        return query, hits
+        # Load the inverted index of the processed data
+        self.index = init_index(self.data_path)
+        self.doc_indices = {doc_id: i for i, doc_id
+                            in enumerate(self.index.doc_ids.tolist())}
+
+    def _score(self, query: str) -> np.ndarray:
+        # Clean and tokenize the query and drop words outside the index
+        terms = [self.index.terms[word] for word in clean_query(query)
+                 if word in self.index.terms]
+
+        # Scores of all documents (nonzero if they contain a word in the query)
+        return calculate_bm25_scores(terms, self.index)
 
     def rank_one(self, query: str, doc_id: int) -> float:
-        query, hits = self._process_query(query)
-        if not any(doc.id == doc_id for doc in hits):
+        if doc_id not in self.doc_indices:
             return 0.0
-        results = calculate_bm25(query, hits)
-        return next(filter(lambda result: result[0] == doc_id, results))[1]
+        return self._score(query)[self.doc_indices[doc_id]].item()
 
     def rank(self, query: str, doc_ids: list[int]) -> list[tuple[int, float]]:
-        scores = dict.fromkeys(doc_ids, 0.0)
-        query, hits = self._process_query(query)
-        for doc_id, score in calculate_bm25(query, hits):
-            if doc_id in scores:
-                scores[doc_id] = score
-        return list(scores.items())
+        scores = self._score(query)
+        return [(doc_id, scores[self.doc_indices[doc_id]].item()
+                 if doc_id in self.doc_indices else 0.0)
+                for doc_id in doc_ids]
 
     def rank_topk(self, query: str, topk: int) -> list[tuple[int, float]]:
-        query, hits = self._process_query(query)
-        return calculate_bm25(query, hits)[:topk]
+        scores = self._score(query)
+        return rank_scores(scores, self.index.doc_ids, topk,
+                           np.flatnonzero(scores))
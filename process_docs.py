@@ -1,12 +1,17 @@
 from __future__ import annotations
 
+import functools
 import time
 from collections import Counter
 
+import numpy as np
 from torchtext.vocab import Vocab
 
-from doctypes import Document, LanguageModel, TokenizedDocument
-from util import clean_words, convert_stoi, get_docs_size, read_docs, save_processed_data
+from doctypes import Document, InvertedIndex, LanguageModel, TokenizedDocument
+from ranker import calculate_tf
+from util import (clean_words, convert_stoi, get_docs_size, get_index_path,
+                  is_outdated, load_index, load_processed_data, read_docs,
+                  save_index, save_processed_data)
 
 
 def preprocess_docs(docs: list[Document]) -> list[TokenizedDocument[str]]:
@@ -66,6 +71,79 @@ def create_inverted_index(
     return index
 
 
+def create_index(
+    docs: list[TokenizedDocument[str]],
+    vocab: Vocab,
+    smoothing_constant: int = 1,
+) -> InvertedIndex:
+    # Index documents in order of id and sort postings by term, then document,
+    # so that scoring a posting list reads document statistics sequentially
+    docs = sorted(docs, key=lambda doc: doc.id)
+    terms, term_ids, ids, tfs = {}, [], [], []
+    for i, doc in enumerate(docs):
+        for word, tf in calculate_tf(doc).items():
+            term_ids.append(terms.setdefault(word, len(terms)))
+            ids.append(i)
+            tfs.append(tf)
+    order = np.lexsort((ids, term_ids))
+    term_ids = np.asarray(term_ids, dtype=np.int64)[order]
+    ids = np.asarray(ids, dtype=np.int32)[order]
+    tfs = np.asarray(tfs, dtype=np.float32)[order]
+
+    # The last term index is for words outside the collection
+    df = np.bincount(term_ids, minlength=len(terms) + 1)
+    cf = np.bincount(term_ids, weights=tfs, minlength=len(terms) + 1)
+    offsets = np.zeros(len(df) + 1, dtype=np.int64)
+    np.cumsum(df, out=offsets[1:])
+
+    # BM25 statistics
+    doc_lens = np.asarray([len(doc.title) + len(doc.content) for doc in docs],
+                          dtype=np.float64)
+    doc_len_norm = (doc_lens / doc_lens.mean()).astype(np.float32)
+    with np.errstate(divide='ignore'):
+        idf = np.where(df > 0, np.log(len(docs) / df), 0.0).astype(np.float32)
+    max_tfs = np.append(np.maximum.reduceat(tfs, offsets[:-2]), 0.0)
+    min_len_norm = np.append(
+        np.minimum.reduceat(doc_len_norm[ids], offsets[:-2]), 0.0)
+
+    # Language model statistics (see create_language_models)
+    doc_totals = smoothing_constant * len(vocab) + doc_lens
+    collection_probs = ((cf + smoothing_constant * len(docs)) /
+                        doc_totals.sum())
+
+    return InvertedIndex(
+        terms=terms,
+        doc_ids=np.asarray([doc.id for doc in docs], dtype=np.int64),
+        doc_len_norm=doc_len_norm, doc_totals=doc_totals,
+        doc_unseen_probs=smoothing_constant / doc_totals,
+        offsets=offsets, postings_ids=ids, postings_tfs=tfs, idf=idf,
+        max_tfs=max_tfs.astype(np.float32),
+        min_len_norm=min_len_norm.astype(np.float32),
+        collection_probs=collection_probs)
+
+
+def get_smoothing_constant(data: dict, default: int = 1) -> int:
+    # The index must be smoothed like the language models if there are any
+    models = data.get('language_models')
+    return models[0].smoothing_constant if models else default
+
+
+@functools.lru_cache(maxsize=1)
+def init_index(
+    processed_data_path: str = 'files/test_data_processed.pickle',
+) -> InvertedIndex:
+    index_path = get_index_path(processed_data_path)
+
+    # Processed data saved without an index, or since it, must be indexed here
+    if is_outdated(index_path, processed_data_path):
+        data = load_processed_data(processed_data_path, convert_to_string=True)
+        index = create_index(data['docs'], data['vocab'],
+                             get_smoothing_constant(data))
+        save_index(index, index_path)
+
+    return load_index(index_path)
+
+
 def main(
     input_path: str = 'files/test_data.csv',
     output_path: str = 'files/test_data_processed.pickle',
@@ -99,6 +177,9 @@ def main(
         models = create_language_models(docs, vocab, smoothing_constant)
         result['language_models'] = models
         result['collection_model'] = create_collection_model(models)
+    do_create_index = do_create_inverted_index or do_create_language_models
+    if do_create_index:
+        index = create_index(docs, vocab, get_smoothing_constant(result))
     for doc in docs:
         convert_stoi(doc.title, vocab)
         convert_stoi(doc.content, vocab)
@@ -112,6 +193,11 @@ def main(
     save_processed_data(result, output_path)
     print(f'result saved at {output_path}')
 
+    if do_create_index:
+        index_path = get_index_path(output_path)
+        save_index(index, index_path)
+        print(f'index saved at {index_path}')
+
 
 if __name__ == '__main__':
     import argparse
@@ -2,9 +2,18 @@ from __future__ import annotations
 
 import functools
 import math
+import os
 from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 
-from doctypes import LanguageModel, TokenizedDocument
+import numpy as np
+
+from doctypes import InvertedIndex, LanguageModel, TokenizedDocument
+
+try:
+    import numba
+except ImportError:  # Fall back to NumPy for BM25 scoring
+    numba = None
 
 
 def calculate_precision_at_k(R: list, k: int) -> float:
@@ -177,6 +186,38 @@ def calculate_interpolated_sentence_probability(
         return functools.reduce(lambda p, w: p * f(w), sentence, 1)
 
 
+def calculate_qlm_scores(
+    terms: list[int],
+    index: InvertedIndex,
+    alpha: float = 0.75,
+    normalize: bool = False,
+) -> np.ndarray:
+    """Calculate the interpolated query probabilities of all documents in an index.
+
+    Arguments:
+        terms: term indices of the query words (the last for unknown words)
+        index: inverted index of the collection
+        alpha: document-collection interpolation constant
+        normalize: if set to true, normalize with log
+    Returns:
+        array of query probabilities for each document index
+    """
+    doc_unseen_probs = alpha * np.asarray(index.doc_unseen_probs)
+    scores = np.full(len(index.doc_ids), 0.0 if normalize else 1.0)
+    for t in terms:
+        # Probability of the word in every document, then in those it occurs
+        p = doc_unseen_probs + (1 - alpha) * index.collection_probs[t]
+        start, end = index.offsets[t], index.offsets[t + 1]
+        ids = index.postings_ids[start:end]
+        p[ids] += alpha * index.postings_tfs[start:end] / index.doc_totals[ids]
+        if normalize:
+            with np.errstate(divide='ignore'):
+                scores += np.log(p)
+        else:
+            scores *= p
+    return scores
+
+
 def calculate_tf(doc: TokenizedDocument[str]) -> Counter[str, int]:
     """Calculate term frequency for all words in a document.
 
@@ -255,3 +296,208 @@ def calculate_bm25(
         scores[doc.id] = rsv_d
 
     return sorted(scores.items(), key=lambda kv: kv[1], reverse=True)
+
+
+# Postings are scored in blocks so that the gathered lengths and contributions
+# of a block stay in cache (NumPy) or registers (Numba) between passes
+_NUMPY_BLOCK_SIZE = 4096
+_NUMBA_BLOCK_SIZE = 64
+
+# Below this many postings a query is scored faster in the calling thread
+_THREADED_MIN_POSTINGS = 1 << 18
+
+# MaxScore costs a few passes over the documents, so it only pays off for
+# queries with a posting per few documents, and skipping to a posting costs
+# about as much as scoring several (benchmarked on 1M documents, 40M postings)
+_MAXSCORE_MAX_TOPK = 1000
+_MAXSCORE_DOCS_PER_POSTING = 8
+_MAXSCORE_SKIP_COST = 8
+
+
+def _calculate_bm25_scores_numpy(terms, idf, offsets, ids, tfs, L, k1, b):
+    scores = np.zeros(len(L), dtype=np.float32)
+    for t in terms:
+        for start in range(offsets[t], offsets[t + 1], _NUMPY_BLOCK_SIZE):
+            end = min(start + _NUMPY_BLOCK_SIZE, offsets[t + 1])
+            ids_td, tf_td = ids[start:end], tfs[start:end]
+            # Each document occurs once in a posting list, so no add.at needed
+            scores[ids_td] += idf[t] * (((k1 + 1) * tf_td) /
+                                        ((k1 * ((1 - b) + b * L[ids_td]) + tf_td)))
+    return scores
+
+
+@functools.lru_cache(maxsize=1)
+def _get_executor() -> ThreadPoolExecutor:
+    return ThreadPoolExecutor(max_workers=os.cpu_count())
+
+
+def _calculate_bm25_scores_threaded(terms, idf, offsets, *args):
+    # NumPy releases the GIL, so shards of the terms can be scored in threads
+    # once there are enough postings to outweigh the cost of the threads
+    num_shards = min(os.cpu_count() or 1, len(terms))
+    num_postings = (offsets[terms + 1] - offsets[terms]).sum()
+    if num_shards <= 1 or num_postings < _THREADED_MIN_POSTINGS:
+        return _calculate_bm25_scores_numpy(terms, idf, offsets, *args)
+    shards = [terms[i::num_shards] for i in range(num_shards)]
+    partial = _get_executor().map(
+        lambda shard: _calculate_bm25_scores_numpy(shard, idf, offsets, *args),
+        shards)
+    scores = next(partial)
+    for shard_scores in partial:
+        scores += shard_scores
+    return scores
+
+
+if numba is not None:
+    @numba.njit(cache=True, fastmath=True, nogil=True, parallel=True)
+    def _calculate_bm25_scores_numba(terms, idf, offsets, ids, tfs, L, k1, b):
+        # Each thread accumulates a share of the terms into its own buffer
+        num_threads = min(numba.get_num_threads(), len(terms))
+        partial = np.zeros((num_threads, len(L)), dtype=np.float32)
+        for i in numba.prange(num_threads):
+            L_d = np.empty(_NUMBA_BLOCK_SIZE, dtype=np.float32)
+            rsv_td = np.empty(_NUMBA_BLOCK_SIZE, dtype=np.float32)
+            for t in terms[i::num_threads]:
+                idf_t = idf[t]
+                for start in range(offsets[t], offsets[t + 1], _NUMBA_BLOCK_SIZE):
+                    n = min(_NUMBA_BLOCK_SIZE, offsets[t + 1] - start)
+                    # Gather document lengths of the block
+                    for j in range(n):
+                        L_d[j] = L[ids[start + j]]
+                    # Contiguous, branch-free arithmetic which vectorizes
+                    for j in range(n):
+                        tf_td = tfs[start + j]
+                        rsv_td[j] = idf_t * (((k1 + 1) * tf_td) /
+                                             ((k1 * ((1 - b) + b * L_d[j]) + tf_td)))
+                    # Scatter the block into the thread buffer
+                    for j in range(n):
+                        partial[i, ids[start + j]] += rsv_td[j]
+
+        # Reduce the thread buffers
+        scores = np.zeros(len(L), dtype=np.float32)
+        for d in numba.prange(len(L)):
+            for i in range(num_threads):
+                scores[d] += partial[i, d]
+        return scores
+
+
+def calculate_bm25_scores(
+    terms: list[int],
+    index: InvertedIndex,
+    k1: float = 1.2,
+    b: float = 0.75,
+) -> np.ndarray:
+    """Calculate the BM25 scores of all documents in an index for the query.
+
+    Uses a Numba kernel if Numba is installed, otherwise falls back to NumPy with \
+    the query terms split across threads.
+
+    Arguments:
+        terms: term indices of the query words
+        index: inverted index of the collection
+        k1: document frequency scaling factor
+        b: document length scaling factor
+    Returns:
+        array of BM25 scores for each document index (zero if no query word)
+    """
+    calculate = (_calculate_bm25_scores_threaded if numba is None
+                 else _calculate_bm25_scores_numba)
+    return calculate(np.asarray(terms, dtype=np.int64), index.idf,
+                     index.offsets, index.postings_ids, index.postings_tfs,
+                     index.doc_len_norm, k1, b)
+
+
+def _calculate_bm25_maxscore(terms, index, topk, k1, b):
+    # Upper bound of the contribution of each term to a document score
+    tf_td, L = index.max_tfs[terms], index.min_len_norm[terms]
+    max_scores = index.idf[terms] * (((k1 + 1) * tf_td) /
+                                     ((k1 * ((1 - b) + b * L) + tf_td)))
+
+    # Score terms with higher upper bounds first
+    order = np.argsort(-max_scores, kind='stable')
+    terms, max_scores = terms[order], max_scores[order]
+    scored = np.cumsum(max_scores)
+    remaining = scored[-1] - scored
+
+    # The k-th best score cannot exceed the bounds of the terms scored so far,
+    # so score every document until those outweigh the remaining terms
+    essential = np.flatnonzero(scored > remaining)
+    if len(essential) == 0 or essential[0] == len(terms) - 1:
+        return calculate_bm25_scores(terms, index, k1, b)
+    i = essential[0] + 1
+    scores = calculate_bm25_scores(terms[:i], index, k1, b)
+
+    # Keep the documents which can still reach the k-th best score, unless the
+    # bounds are too loose for skipping to beat scoring the remaining postings
+    if i == 1:
+        t = terms[0]
+        hits = index.postings_ids[index.offsets[t]:index.offsets[t + 1]]
+    else:
+        hits = np.flatnonzero(scores > 0)
+    candidates = None
+    if len(hits) >= topk:
+        hit_scores = scores[hits]
+        threshold = np.partition(hit_scores, -topk)[-topk]
+        if threshold > remaining[i - 1]:
+            candidates = hits[hit_scores + remaining[i - 1] >= threshold]
+    rest = terms[i:]
+    num_postings = (index.offsets[rest + 1] - index.offsets[rest]).sum()
+    if (candidates is None
+            or len(candidates) * _MAXSCORE_SKIP_COST > num_postings):
+        scores += calculate_bm25_scores(rest, index, k1, b)
+        return scores
+
+    for t, remaining_t in zip(rest, remaining[i:]):
+        start, end = index.offsets[t], index.offsets[t + 1]
+        ids = index.postings_ids[start:end]
+        tf_td = index.postings_tfs[start:end]
+        if len(ids) == 0:
+            continue
+
+        # Skip to the postings of the candidates (postings are sorted by index)
+        pos = np.minimum(np.searchsorted(ids, candidates), len(ids) - 1)
+        pos = pos[ids[pos] == candidates]
+        ids, tf_td = ids[pos], tf_td[pos]
+
+        L = index.doc_len_norm[ids]
+        scores[ids] += index.idf[t] * (((k1 + 1) * tf_td) /
+                                       ((k1 * ((1 - b) + b * L) + tf_td)))
+
+        candidate_scores = scores[candidates]
+        threshold = np.partition(candidate_scores, -topk)[-topk]
+        candidates = candidates[candidate_scores + remaining_t >= threshold]
+
+    return scores
+
+
+def calculate_bm25_topk_scores(
+    terms: list[int],
+    index: InvertedIndex,
+    topk: int,
+    k1: float = 1.2,
+    b: float = 0.75,
+) -> np.ndarray:
+    """Calculate the BM25 scores of the top k documents in an index for the query.
+
+    Uses MaxScore pruning: terms are scored in descending order of their maximum \
+    contribution, and once no unscored document can reach the current k-th best \
+    score, the remaining terms are only scored for documents which still can. \
+    Falls back to scoring all documents if k is large, the query has too few \
+    postings, or the bounds leave too many documents for pruning to pay off.
+
+    Arguments:
+        terms: term indices of the query words
+        index: inverted index of the collection
+        topk: number of documents whose scores must be exact
+        k1: document frequency scaling factor
+        b: document length scaling factor
+    Returns:
+        array of BM25 scores for each document index (only exact for the top k)
+    """
+    terms = np.asarray(terms, dtype=np.int64)
+    num_postings = (index.offsets[terms + 1] - index.offsets[terms]).sum()
+    if (len(terms) < 2 or not 0 < topk <= _MAXSCORE_MAX_TOPK
+            or topk >= len(index.doc_ids)
+            or num_postings * _MAXSCORE_DOCS_PER_POSTING < len(index.doc_ids)):
+        return calculate_bm25_scores(terms, index, k1, b)
+    return _calculate_bm25_maxscore(terms, index, topk, k1, b)
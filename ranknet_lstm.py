@@ -11,7 +11,8 @@ from torch import nn
 from torch.utils.data import DataLoader
 from torchtext.vocab import Vocab
 
-from util import doc_pipeline, query_pipeline, load_processed_data
+from util import (doc_pipeline, get_ranknet_docs_path, query_pipeline,
+                  load_processed_data, tokenized_doc_pipeline)
 
 
 class RankNetLSTM(nn.Module):
@@ -34,6 +35,8 @@ class RankNetLSTM(nn.Module):
 
     Arguments:
         vocab: Vocab from the preprocessed data
+        load_vectors: if set to false, skip loading GLoVe embeddings (for models \
+                      whose state will be loaded from a file)
 
     ----------
     DISCLAIMER
@@ -46,11 +49,16 @@ class RankNetLSTM(nn.Module):
     the future might want to use a larger, human-labelled dataset.
     """
 
-    def __init__(self, vocab: Vocab):
+    def __init__(self, vocab: Vocab, load_vectors: bool = True):
         super(RankNetLSTM, self).__init__()
-        vocab.load_vectors('glove.6B.50d')
-        self.embed = nn.Embedding.from_pretrained(
-            vocab.vectors, freeze=True, padding_idx=vocab.stoi['<pad>'])
+        if load_vectors:
+            vocab.load_vectors('glove.6B.50d')
+            self.embed = nn.Embedding.from_pretrained(
+                vocab.vectors, freeze=True, padding_idx=vocab.stoi['<pad>'])
+        else:
+            self.embed = nn.Embedding(
+                len(vocab), 50, padding_idx=vocab.stoi['<pad>'])
+            self.embed.weight.requires_grad = False
         self.query_lstm = nn.LSTM(
             input_size=50, hidden_size=50, bias=True, batch_first=True)
         self.doc_lstm = nn.LSTM(
@@ -60,14 +68,41 @@ class RankNetLSTM(nn.Module):
     def forward(self, query, doc):
         query = self.query_lstm(self.embed(query))[0].mean(dim=1)
         doc = self.doc_lstm(self.embed(doc))[0].mean(dim=1)
+        # A single query is broadcast across the batch of documents
+        query = query.expand(doc.size(0), -1)
         query_doc = torch.cat([query, doc], dim=1)
-        return self.linear(query_doc)
+        # Score in full precision even if the encoders ran under autocast
+        with torch.cuda.amp.autocast(enabled=False):
+            return self.linear(query_doc.float())
 
 
 def rank_net_loss(pos_score, neg_score, gamma):
     return torch.log(1 + torch.exp(-gamma * (pos_score - neg_score))).mean()
 
 
+def preprocess_docs_for_ranknet(
+    processed_data_path: str = 'files/test_data_processed.pickle',
+    doc_len: int = 200,
+    output_path: str | None = None,
+):
+    """Save the document tensors that RankNetLSTM scores during search.
+
+    Arguments:
+        processed_data_path: path to load processed data
+        doc_len: document length to trim/pad to
+        output_path: path to save document ids and tensors (derived if None)
+    """
+    if output_path is None:
+        output_path = get_ranknet_docs_path(processed_data_path, doc_len)
+    data = load_processed_data(processed_data_path)
+    docs, vocab = data['docs'], data['vocab']
+    doc_ids = torch.tensor([doc.id for doc in docs], dtype=torch.int64)
+    docs = torch.stack([tokenized_doc_pipeline(doc, vocab, doc_len)
+                        for doc in docs])
+    torch.save({'doc_ids': doc_ids, 'docs': docs}, output_path,
+               _use_new_zipfile_serialization=True)
+
+
 def main(
     labelled_data_path: str = 'files/test_data_labelled.json',
     processed_data_path: str = 'files/test_data_processed.pickle',
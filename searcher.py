@@ -1,25 +1,32 @@
 from __future__ import annotations
 
+import contextlib
 import functools
 import os
 import pickle
 from typing import Literal
 
+import numpy as np
 import torch
 from sentence_transformers import CrossEncoder, SentenceTransformer
 from sentence_transformers import util as sbert_util
 
-from ranker import calculate_bm25, calculate_interpolated_sentence_probability
-from ranknet_lstm import RankNetLSTM
-from util import (convert_itos, doc_pipeline, fmt_secs, load_processed_data,
-                  print_search_results, query_pipeline, read_docs, timed,
-                  tokenized_doc_pipeline)
+from process_docs import init_index
+from ranker import (calculate_bm25_scores, calculate_bm25_topk_scores,
+                    calculate_qlm_scores)
+from ranknet_lstm import RankNetLSTM, preprocess_docs_for_ranknet
+from util import (clean_query, convert_itos, dbm_cached, doc_pipeline, fmt_secs,
+                  get_ranknet_docs_path, is_outdated, load_processed_data,
+                  print_search_results, query_pipeline, rank_scores, read_docs,
+                  timed)
 
 
 def bm25_search(
     query: str,
     processed_data_path: str,
     topk: int | None = None,
+    k1: float = 1.2,
+    b: float = 0.75,
 ) -> list[tuple[int, float]]:
     """Return the top k document ids and scores using BM25.
 
@@ -27,28 +34,27 @@ def bm25_search(
         query: query string
         processed_data_path: path to load processed data
         topk: number of results to return
+        k1: document frequency scaling factor
+        b: document length scaling factor
     Returns:
         ranked list of document id-score tuples (best score first)
     """
-    # Load the processed data
-    data = load_processed_data(processed_data_path, convert_to_string=True)
-    vocab = data['vocab']
-    docs_map = {doc.id: doc for doc in data['docs']}
-    inverted_index = data['inverted_index']
-
-    # Process query
-    query = query_pipeline(query, vocab, length=None, to='str')
+    # Initialize search
+    index = init_index(processed_data_path)
 
-    # Get the ids of all documents with a word in the query
-    doc_ids = set(doc_id for word in query for doc_id in inverted_index[word])
+    # Process query (words outside the index cannot contribute to the score)
+    query = clean_query(query)
 
-    # Get the respective documents
-    hits = [docs_map[doc_id] for doc_id in doc_ids]
-    if not hits:
-        return []
+    # Calculate scores of all documents using the inverted index
+    terms = [index.terms[word] for word in query if word in index.terms]
+    if topk is not None:
+        scores = calculate_bm25_topk_scores(terms, index, topk, k1, b)
+    else:
+        scores = calculate_bm25_scores(terms, index, k1, b)
 
-    # Call the BM25 algorithm and return the top k results
-    return calculate_bm25(query, hits)[:topk]
+    # Rank scores of documents with a word in the query and return top k results
+    hits = np.flatnonzero(scores)
+    return rank_scores(scores, index.doc_ids, topk, hits)
 
 
 def qlm_search(
@@ -69,25 +75,52 @@ def qlm_search(
     Returns:
         ranked list of document id-score tuples (best score first)
     """
-    # Load the processed data
-    data = load_processed_data(processed_data_path)
-    vocab = data['vocab']
-    models_map = {model.id: model for model in data['language_models']}
-    collection_model = data['collection_model']
+    # Initialize search
+    index = init_index(processed_data_path)
 
-    # Process query
-    query = query_pipeline(query, vocab, length=None, to='str')
+    # Process query (words outside the collection share the last term index)
+    query = clean_query(query)
+    terms = [index.terms.get(word, len(index.terms)) for word in query]
 
-    # Calculate scores using language models
-    scores = []
-    for doc_id, model in models_map.items():
-        score = calculate_interpolated_sentence_probability(
-            model, collection_model, query, alpha, normalize)
-        scores.append((doc_id, score))
+    # Calculate scores of all documents using the inverted index
+    scores = calculate_qlm_scores(terms, index, alpha, normalize)
 
     # Rank scores and return top k results
-    scores.sort(key=lambda kv: kv[1], reverse=True)
-    return scores[:topk]
+    return rank_scores(scores, index.doc_ids, topk)
+
+
+@functools.lru_cache(maxsize=2)
+def load_ranknet_lstm(
+    processed_data_path: str = 'files/test_data_processed.pickle',
+    model_path: str = 'files/ranknet_lstm.pt',
+    low_precision: bool = False,
+):
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    vocab = load_processed_data(processed_data_path)['vocab']
+
+    # The embeddings are part of the saved state, so skip loading GLoVe
+    model = RankNetLSTM(vocab, load_vectors=False)
+    try:
+        state_dict = torch.load(model_path, map_location=device,
+                                weights_only=True)
+    except TypeError:  # weights_only requires PyTorch 1.13
+        state_dict = torch.load(model_path, map_location=device)
+    model.load_state_dict(state_dict)
+    model = model.to(device).eval()
+
+    # Use int8 LSTM and linear kernels on CPU (GPU runs under autocast instead)
+    if low_precision and device.type == 'cpu':
+        model = torch.quantization.quantize_dynamic(
+            model, {torch.nn.LSTM, torch.nn.Linear}, dtype=torch.qint8)
+
+    return model, vocab, device
+
+
+def ranknet_lstm_autocast(low_precision: bool = False):
+    # Run the RankNetLSTM encoders in float16 on GPU
+    if low_precision and torch.cuda.is_available():
+        return torch.cuda.amp.autocast()
+    return contextlib.nullcontext()
 
 
 @functools.lru_cache(maxsize=1)
@@ -95,29 +128,63 @@ def init_ranknet_lstm_search(
     processed_data_path: str = 'files/test_data_processed.pickle',
     model_path: str = 'files/ranknet_lstm.pt',
     doc_len: int = 200,
+    low_precision: bool = False,
 ):
-    # Load the processed data
-    data = load_processed_data(processed_data_path)
-    docs = data['docs']
-    vocab = data['vocab']
-
-    # Load the model
-    model = RankNetLSTM(vocab)
-    model.load_state_dict(torch.load(model_path))
-    model.eval()
-
-    # Calculate scores using model
-    with torch.no_grad():
-        doc_pipeline = functools.partial(tokenized_doc_pipeline,
-                                         vocab=vocab, length=doc_len)
-        corpus_embeddings = list(map(doc_pipeline, docs))
-        corpus_embeddings = torch.stack(corpus_embeddings)
+    # Load the model and the vocab it was trained with
+    model, vocab, device = load_ranknet_lstm(processed_data_path, model_path,
+                                             low_precision)
 
-    if torch.cuda.is_available():
-        model = model.to('cuda')
-        corpus_embeddings = corpus_embeddings.to('cuda')
+    # Load the document tensors, preprocessing them if they are not saved yet
+    # or the processed data changed since (the data is already in memory, as
+    # load_processed_data is cached)
+    corpus_path = get_ranknet_docs_path(processed_data_path, doc_len)
+    if is_outdated(corpus_path, processed_data_path):
+        preprocess_docs_for_ranknet(processed_data_path, doc_len, corpus_path)
+    corpus = torch.load(corpus_path)
+    doc_ids = corpus['doc_ids'].numpy()
+    corpus_embeddings = corpus['docs']
+
+    # The documents are copied once, so pinning them would not pay off
+    corpus_embeddings = corpus_embeddings.to(device)
 
-    return docs, vocab, model, corpus_embeddings
+    return doc_ids, vocab, model, corpus_embeddings
+
+
+@functools.lru_cache(maxsize=1)
+def init_ranknet_lstm_query_buffer(query_len: int = 50):
+    # Pinned host memory lets queries be copied to the GPU asynchronously
+    return torch.empty(1, query_len, dtype=torch.int64, pin_memory=True)
+
+
+@functools.lru_cache(maxsize=1)
+def init_ranknet_lstm_graph(
+    model: RankNetLSTM,
+    batch_size: int = 64,
+    query_len: int = 50,
+    doc_len: int = 200,
+    low_precision: bool = False,
+):
+    # Static inputs are refilled before each replay of the captured forward
+    static_query = torch.zeros(1, query_len, dtype=torch.int64, device='cuda')
+    static_doc = torch.zeros(batch_size, doc_len, dtype=torch.int64,
+                             device='cuda')
+
+    # Warm up on a side stream before capture
+    stream = torch.cuda.Stream()
+    stream.wait_stream(torch.cuda.current_stream())
+    with torch.cuda.stream(stream), torch.no_grad():
+        with ranknet_lstm_autocast(low_precision):
+            for _ in range(3):
+                model(static_query, static_doc)
+    torch.cuda.current_stream().wait_stream(stream)
+
+    # Capture the forward pass
+    graph = torch.cuda.CUDAGraph()
+    with torch.no_grad(), torch.cuda.graph(graph):
+        with ranknet_lstm_autocast(low_precision):
+            static_scores = model(static_query, static_doc).flatten()
+
+    return graph, static_query, static_doc, static_scores
 
 
 def ranknet_lstm_search(
@@ -127,6 +194,8 @@ def ranknet_lstm_search(
     topk: int | None = None,
     query_len: int = 50,
     doc_len: int = 200,
+    batch_size: int = 64,
+    low_precision: bool = False,
 ) -> list[tuple[int, float]]:
     """Return the top k document ids and scores using RankNetLSTM.
 
@@ -137,28 +206,44 @@ def ranknet_lstm_search(
         topk: number of results to return
         query_len: query length to trim/pad to
         doc_len: document length to trim/pad to
+        batch_size: number of documents to score at a time
+        low_precision: if set to true, run the model in int8 on CPU or float16 on GPU
     Returns:
         ranked list of document id-score tuples (best score first)
     """
     # Initialize search
-    docs, vocab, model, corpus_embeddings = init_ranknet_lstm_search(
-        processed_data_path, model_path, doc_len)
+    doc_ids, vocab, model, corpus_embeddings = init_ranknet_lstm_search(
+        processed_data_path, model_path, doc_len, low_precision)
 
-    # Process query
-    query_embedding = query_pipeline(query, vocab, query_len)
-    query_embeddings = torch.stack([query_embedding] * len(corpus_embeddings))
+    # Process query (the model broadcasts it across each batch)
+    query_embedding = query_pipeline(query, vocab, query_len).unsqueeze(0)
     if torch.cuda.is_available():
-        query_embeddings = query_embeddings.to('cuda')
+        query_buffer = init_ranknet_lstm_query_buffer(query_len)
+        query_buffer.copy_(query_embedding)
+        query_embedding = query_buffer.to('cuda', non_blocking=True)
+
+    # Calculate scores by replaying the captured model (requires PyTorch 1.10)
+    if torch.cuda.is_available() and hasattr(torch.cuda, 'graph'):
+        graph, static_query, static_doc, static_scores = init_ranknet_lstm_graph(
+            model, batch_size, query_len, doc_len, low_precision)
+        static_query.copy_(query_embedding)
+        scores = []
+        for batch in torch.split(corpus_embeddings, batch_size):
+            static_doc[:len(batch)].copy_(batch)
+            graph.replay()
+            scores.append(static_scores[:len(batch)].clone())
+
+    # Calculate scores using model (inference mode requires PyTorch 1.9)
+    else:
+        inference_mode = getattr(torch, 'inference_mode', torch.no_grad)
+        with inference_mode(), ranknet_lstm_autocast(low_precision):
+            scores = [model(query_embedding, batch).flatten()
+                      for batch in torch.split(corpus_embeddings, batch_size)]
 
-    # Calculate scores using model
-    with torch.no_grad():
-        scores = model(query_embeddings, corpus_embeddings)
-        scores = scores.detach().flatten().tolist()
-        scores = [(doc.id, score) for doc, score in zip(docs, scores)]
+    scores = torch.cat(scores)
 
-    # Rank scores and return top k results
-    scores.sort(key=lambda kv: kv[1], reverse=True)
-    return scores[:topk]
+    # Rank scores and return top k results (ties in document order)
+    return rank_scores(scores.cpu().numpy(), doc_ids, topk)
 
 
 @functools.lru_cache(maxsize=1)
@@ -223,13 +308,11 @@ def sbert_search(
 
     # Rerank with cross-encoder
     cross_input = [[query, doc_pipeline(docs[i])] for i in hits]
-    scores = cross_encoder.predict(cross_input)
-    scores = scores.flatten().tolist()
-    scores = [(docs[i].id, score) for i, score in zip(hits, scores)]
+    scores = cross_encoder.predict(cross_input).flatten()
 
     # Rank scores and return top k results
-    scores.sort(key=lambda kv: kv[1], reverse=True)
-    return scores[:topk]
+    doc_ids = np.asarray([docs[i].id for i in hits])
+    return rank_scores(scores, doc_ids, topk)
 
 
 @functools.lru_cache(maxsize=1)
@@ -260,7 +343,8 @@ def init_dpr_search(raw_data_path: str = 'files/test_data.csv'):
         query_encoder = query_encoder.to('cuda')
         corpus_embeddings = corpus_embeddings.to('cuda')
 
-    return docs, corpus_embeddings, query_encoder
+    doc_ids = np.asarray([doc.id for doc in docs])
+    return doc_ids, corpus_embeddings, query_encoder
 
 
 def dpr_search(
@@ -280,7 +364,7 @@ def dpr_search(
         ranked list of document id-score tuples (best score first)
     """
     # Initialize search
-    docs, corpus_embeddings, query_encoder = init_dpr_search(raw_data_path)
+    doc_ids, corpus_embeddings, query_encoder = init_dpr_search(raw_data_path)
 
     # Process query
     query_embedding = query_encoder.encode(query, convert_to_tensor=True)
@@ -288,13 +372,10 @@ def dpr_search(
         query_embedding = query_embedding.to('cuda')
 
     # Calculate scores using dot product
-    scores = sbert_util.dot_score(query_embedding, corpus_embeddings)
-    scores = scores.flatten().tolist()
-    scores = [(doc.id, score) for doc, score in zip(docs, scores)]
+    scores = sbert_util.dot_score(query_embedding, corpus_embeddings).flatten()
 
-    # Rank scores and return top k results
-    scores.sort(key=lambda kv: kv[1], reverse=True)
-    return scores[:topk]
+    # Rank scores and return top k results (ties in document order)
+    return rank_scores(scores.cpu().numpy(), doc_ids, topk)
 
 
 def main(
@@ -310,6 +391,8 @@ def main(
     ranknet_lstm_model_path: str | None = 'files/ranknet_lstm.pt',
     query_len: int | None = 50,
     doc_len: int | None = 200,
+    low_precision: bool = False,
+    cache_path: str | None = None,
 ):
     """Make a search query.
 
@@ -326,6 +409,8 @@ def main(
         ranknet_lstm_model_path: path to load model state for ranknet-lstm search
         query_len: query length to trim/pad to
         doc_len: document length to trim/pad to
+        low_precision: if set to true, run ranknet-lstm search in int8 on CPU or float16 on GPU
+        cache_path: path to cache search results in (no caching if unset)
     """
     search_fn = None
     args = [None]
@@ -344,6 +429,7 @@ def main(
         args.append(ranknet_lstm_model_path)
         kwargs['query_len'] = query_len
         kwargs['doc_len'] = doc_len
+        kwargs['low_precision'] = low_precision
     elif type == 'sbert':
         search_fn = sbert_search
         args.append(raw_data_path)
@@ -352,6 +438,8 @@ def main(
         args.append(raw_data_path)
     else:
         raise ValueError(f'invalid type provided: {type}')
+    if cache_path:
+        search_fn = dbm_cached(search_fn, cache_path)
     while True:
         if query:
             args[0] = query
@@ -419,5 +507,13 @@ if __name__ == '__main__':
         '--doc-len', default=200, type=int,
         help='document length to trim/pad to',
         metavar='DL', dest='doc_len')
+    parser.add_argument(
+        '--low-precision', action='store_true',
+        help='if set to true, run ranknet-lstm search in int8 on CPU or float16 on GPU',
+        dest='low_precision')
+    parser.add_argument(
+        '--cache', default=None,
+        help='path to cache search results in (no caching if unset)',
+        metavar="PATH", dest='cache_path')
     args = parser.parse_args()
     main(**vars(args))
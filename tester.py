@@ -1,9 +1,14 @@
+import dataclasses
+import os
+import tempfile
 from collections import Counter
 
+import numpy as np
 import torch
 from torchtext.vocab import Vocab
 
 from doctypes import Document, LanguageModel, TokenizedDocument
+from process_docs import create_index
 from util import test, test_search
 
 
@@ -52,10 +57,51 @@ def test_process_docs():
              Vocab(Counter('aaabbbcccddddeee'), specials=[]))
     test_create_inverted_index()
 
+    def test_create_index():
+        test(process_docs.create_index,
+             lambda index: ((index.terms,
+                             index.offsets.tolist(),
+                             index.postings_ids.tolist(),
+                             index.doc_len_norm.tolist(),
+                             index.doc_totals.tolist(),
+                             [round(p, 6)
+                              for p in index.collection_probs.tolist()],
+                             round(index.idf[index.terms['d']].item(), 6)),
+                            ({'a': 0, 'b': 1, 'c': 2, 'd': 3, 'e': 4},
+                             [0, 1, 3, 6, 8, 9, 9], [0, 0, 1, 0, 1, 2, 1, 2, 2],
+                             [1.0, 1.0, 1.0], [8.0, 8.0, 8.0],
+                             [0.166667, 0.208333, 0.25, 0.208333, 0.166667,
+                              0.125],
+                             0.405465)),
+             [TokenizedDocument(0, list('a'), list('bc')),
+              TokenizedDocument(1, list('b'), list('cd')),
+              TokenizedDocument(2, list('c'), list('de'))],
+             Vocab(Counter('abcde'), specials=[]), 1)
+        test(process_docs.create_index,
+             lambda index: ((index.doc_ids.tolist(),
+                             index.terms,
+                             index.offsets.tolist(),
+                             index.postings_ids.tolist()),
+                            ([2, 5], {'y': 0, 'x': 1}, [0, 2, 3, 3],
+                             [0, 1, 1])),
+             [TokenizedDocument(5, ['x'], ['y']),
+              TokenizedDocument(2, ['y'], [])],
+             Vocab(Counter('xy'), specials=[]), 1)
+    test_create_index()
+
+
+def create_test_index():
+    return create_index([TokenizedDocument(0, list('a'), list('bc')),
+                         TokenizedDocument(1, list('b'), list('cd')),
+                         TokenizedDocument(2, list('c'), list('de'))],
+                        Vocab(Counter('abcde'), specials=[]), 1)
+
 
 def test_ranker():
     import ranker
 
+    index = create_test_index()
+
     def test_calculate_precision_at_k():
         test(ranker.calculate_precision_at_k, 0.5,
              [1, 1, 0, 1, 0, 1, 0, 0, 0, 1], 10)
@@ -103,6 +149,13 @@ def test_ranker():
              list('ae'), 0.75, False)
     test_calculate_interpolated_sentence_probability()
 
+    def test_calculate_qlm_scores():
+        test(ranker.calculate_qlm_scores,
+             lambda scores: ([round(s, 6) for s in scores.tolist()],
+                             [0.031033, 0.018338, 0.031033]),
+             [index.terms[word] for word in 'ae'], index, 0.75, False)
+    test_calculate_qlm_scores()
+
     def test_calculate_tf():
         test(ranker.calculate_tf, Counter('abcddefg'),
              TokenizedDocument(0, list('abcd'), list('defg')))
@@ -137,6 +190,50 @@ def test_ranker():
              1.2, 0.75)
     test_calculate_bm25()
 
+    def test_calculate_bm25_scores():
+        test(ranker.calculate_bm25_scores,
+             lambda scores: ([round(s, 6) for s in scores.tolist()],
+                             [0.405465, 0.405465, 1.098612]),
+             [index.terms[word] for word in 'bce'], index, 1.2, 0.75)
+    test_calculate_bm25_scores()
+
+    def test_calculate_bm25_scores_numba():
+        if ranker.numba is None:
+            return
+        args = (np.asarray([index.terms[word] for word in 'bce'], dtype=np.int64),
+                index.idf,
+                index.offsets, index.postings_ids, index.postings_tfs,
+                index.doc_len_norm, 1.2, 0.75)
+        test(ranker._calculate_bm25_scores_numba,
+             lambda scores: ([round(s, 6) for s in scores.tolist()],
+                             [round(s, 6) for s in
+                              ranker._calculate_bm25_scores_numpy(*args).tolist()]),
+             *args)
+    test_calculate_bm25_scores_numba()
+
+    def test_calculate_bm25_topk_scores():
+        # Only the first document has the rare word, so the common word is
+        # only scored for it once the top document is known
+        docs = ([TokenizedDocument(0, ['z'], ['a'])] +
+                [TokenizedDocument(i, ['y'], ['a']) for i in range(1, 20)] +
+                [TokenizedDocument(20, ['y'], ['b'])])
+        index = create_index(docs, Vocab(Counter('abyz'), specials=[]), 1)
+        terms = [index.terms[word] for word in 'za']
+        scores = ranker.calculate_bm25_scores(terms, index, 1.2, 0.75)
+
+        def ranked(scores, topk):
+            return sorted(enumerate(round(s, 6) for s in scores.tolist()),
+                          key=lambda x: (-x[1], x[0]))[:topk]
+
+        test(ranker.calculate_bm25_topk_scores,
+             lambda output: ((ranked(output, 1), np.count_nonzero(output)),
+                             (ranked(scores, 1), 1)),
+             terms, index, 1, 1.2, 0.75)
+        test(ranker.calculate_bm25_topk_scores,
+             lambda output: (ranked(output, 2), ranked(scores, 2)),
+             terms, index, 2, 1.2, 0.75)
+    test_calculate_bm25_topk_scores()
+
 
 def test_searcher():
     import searcher
@@ -187,6 +284,12 @@ def test_util():
              '3 killed as Islamic militants attack town')
     test_clean_words()
 
+    def test_clean_query():
+        test(util.clean_query,
+             ('3', 'killed', 'islamic', 'militants', 'attack', 'town'),
+             '3 killed as Islamic militants attack town')
+    test_clean_query()
+
     def test_get_doc():
         test(util.get_doc, lambda doc: (doc.id, 315201),
              315201, 'files/test_data.csv')
@@ -240,6 +343,53 @@ def test_util():
              Vocab(Counter('uuuvvw'), specials=['<pad>']), 4)
     test_tokenized_doc_pipeline()
 
+    def test_load_index():
+        index = create_test_index()
+        fields = [field.name for field in dataclasses.fields(index)
+                  if field.name != 'terms']
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'index')
+            util.save_index(index, path)
+            test(util.load_index,
+                 lambda loaded: (
+                     (loaded.terms,
+                      [(name, getattr(loaded, name).tolist(),
+                        isinstance(getattr(loaded, name), np.memmap))
+                       for name in fields]),
+                     (index.terms,
+                      [(name, getattr(index, name).tolist(), True)
+                       for name in fields])),
+                 path)
+            # Release the memory-mapped files so the directory can be removed
+            util.load_index.cache_clear()
+    test_load_index()
+
+    def test_dbm_cached():
+        calls = []
+
+        def square(x):
+            calls.append(x)
+            return x * x
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            cached = util.dbm_cached(square, os.path.join(tmp_dir, 'cache'))
+            test(cached, lambda output: ((output, calls), (4, [2])), 2)
+            test(cached, lambda output: ((output, calls), (4, [2])), 2)
+            test(cached, lambda output: ((output, calls), (9, [2, 3])), 3)
+    test_dbm_cached()
+
+    def test_rank_scores():
+        scores = np.array([1.0, 0.0, 2.0, 1.0, 0.5, 1.0], dtype=np.float32)
+        doc_ids = np.arange(10, 16)
+        test(util.rank_scores,
+             [(12, 2.0), (10, 1.0), (13, 1.0), (15, 1.0), (14, 0.5), (11, 0.0)],
+             scores, doc_ids)
+        test(util.rank_scores, [(12, 2.0), (10, 1.0)],
+             scores, doc_ids, 2, np.flatnonzero(scores))
+        test(util.rank_scores,
+             [(12, 2.0), (10, 1.0), (13, 1.0), (15, 1.0), (14, 0.5)],
+             scores, doc_ids, 10, np.flatnonzero(scores))
+    test_rank_scores()
+
 
 if __name__ == '__main__':
     test_process_docs()
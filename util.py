@@ -1,20 +1,24 @@
 from __future__ import annotations
 
 import dataclasses
+import dbm
 import functools
+import hashlib
 import json
 import os
 import pickle
 import string
+import zlib
 from timeit import default_timer as timer
 from typing import Literal
 
 import nltk
+import numpy as np
 import pandas as pd
 import torch
 from torchtext.vocab import Vocab
 
-from doctypes import Document, TokenizedDocument
+from doctypes import Document, InvertedIndex, TokenizedDocument
 from ranker import calculate_mean_reciprocal_rank
 
 
@@ -45,6 +49,23 @@ def timed(fn, args, kwargs=None):
     return output, time_taken
 
 
+def dbm_cached(fn, path: str):
+    # Results are keyed by the call arguments, so delete the cache after
+    # reprocessing the data it was built from
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        call = (fn.__name__, args, sorted(kwargs.items()))
+        key = hashlib.sha256(repr(call).encode()).digest()
+        with dbm.open(path, 'c') as db:
+            if key in db:
+                return pickle.loads(zlib.decompress(db[key]))
+        output = fn(*args, **kwargs)
+        with dbm.open(path, 'c') as db:
+            db[key] = zlib.compress(pickle.dumps(output))
+        return output
+    return wrapper
+
+
 def test(fn, expected, *args, **kwargs):
     output, time_taken = timed(fn, args, kwargs)
     if callable(expected):
@@ -112,8 +133,31 @@ def print_search_results(
             print(f"{', ' if i > 0 else ''}{id}", end='')
 
 
+def rank_scores(
+    scores: np.ndarray,
+    doc_ids: np.ndarray,
+    topk: int | None = None,
+    hits: np.ndarray | None = None,
+) -> list[tuple[int, float]]:
+    # Partition out the top k hits in linear time, then only sort those (hits
+    # tied with the k-th score are kept so that ties rank in index order)
+    if hits is None:
+        hits = np.arange(len(scores))
+    if topk is not None and 0 < topk < len(hits):
+        hit_scores = scores[hits]
+        kth = len(hits) - topk
+        hits = hits[hit_scores >= np.partition(hit_scores, kth)[kth]]
+    hits = hits[np.argsort(-scores[hits], kind='stable')][:topk]
+    return list(zip(doc_ids[hits].tolist(), scores[hits].tolist()))
+
+
+@functools.lru_cache(maxsize=1)
+def get_stopwords() -> frozenset[str]:
+    return frozenset(nltk.corpus.stopwords.words('english'))
+
+
 def clean_words(words: str) -> list[str]:
-    stopwords = set(nltk.corpus.stopwords.words('english'))
+    stopwords = get_stopwords()
     punctuation = set(string.punctuation)
     cleaned = []
     for word in nltk.tokenize.word_tokenize(words):
@@ -126,6 +170,12 @@ def clean_words(words: str) -> list[str]:
     return cleaned
 
 
+@functools.lru_cache(maxsize=1024)
+def clean_query(query: str) -> tuple[str, ...]:
+    # Repeated queries skip tokenization; a tuple keeps cached words unchanged
+    return tuple(clean_words(query))
+
+
 def save_processed_data(data: dict, path: str):
     with open(path, 'wb') as fp:
         pickle.dump(data, fp)
@@ -143,6 +193,46 @@ def load_processed_data(path: str, convert_to_string: bool = False) -> dict:
     return data
 
 
+def get_index_path(processed_data_path: str) -> str:
+    root, _ = os.path.splitext(processed_data_path)
+    return f'{root}-index'
+
+
+def get_ranknet_docs_path(processed_data_path: str, doc_len: int) -> str:
+    root, _ = os.path.splitext(processed_data_path)
+    return f'{root}-ranknet_lstm_docs_{doc_len}.pt'
+
+
+def is_outdated(path: str, source_path: str) -> bool:
+    # Derived data must be rebuilt if it is missing or older than its source
+    return (not os.path.exists(path)
+            or os.path.getmtime(path) < os.path.getmtime(source_path))
+
+
+def save_index(index: InvertedIndex, path: str):
+    os.makedirs(path, exist_ok=True)
+    for field in dataclasses.fields(index):
+        if field.name != 'terms':
+            np.save(os.path.join(path, f'{field.name}.npy'),
+                    getattr(index, field.name))
+    with open(os.path.join(path, 'vocab.json'), 'w') as fp:
+        json.dump(index.terms, fp)
+    # Overwriting files leaves the directory time, which staleness checks read
+    os.utime(path)
+
+
+@functools.lru_cache(maxsize=4)
+def load_index(path: str) -> InvertedIndex:
+    # Arrays are memory-mapped, so they are paged in from the OS cache
+    with open(os.path.join(path, 'vocab.json'), 'r') as fp:
+        terms = json.load(fp)
+    arrays = {field.name: np.load(os.path.join(path, f'{field.name}.npy'),
+                                  mmap_mode='r')
+              for field in dataclasses.fields(InvertedIndex)
+              if field.name != 'terms'}
+    return InvertedIndex(terms=terms, **arrays)
+
+
 @functools.lru_cache
 def read_df(path: str) -> pd.DataFrame:
     _, ext = os.path.splitext(path)
@@ -212,8 +302,7 @@ def query_pipeline(
     length: int = 0,
     to: Literal['str', 'tensor'] = 'tensor',
 ) -> list[str] | torch.Tensor:
-    query = clean_words(query)
-    query = convert_stoi(query, vocab)
+    query = convert_stoi(list(clean_query(query)), vocab)
     if length:
         query = pad_sentence(query, vocab, length, trim_end=False)
     if to == 'tensor':